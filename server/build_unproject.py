@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Build the optional AVX2 unprojection extension used by pointcloud.py.
+
+    python build_unproject.py
+
+This compiles under build/ and copies _unproject_avx2.*.so next to this file.
+"""
+import os
+import shutil
+from cffi import FFI
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CDEF = """
+int unproject_has_avx2(void);
+int64_t unproject_count_u16(const uint16_t *depths, int64_t height, int64_t width, uint32_t max_depth);
+int64_t unproject_u16(const uint16_t *depths, int64_t height, int64_t width, uint32_t max_depth,
+                      float inv_scale, const float *u_norm, const float *v_norm,
+                      float *out_xyz, int64_t *out_idx);
+"""
+
+ffibuilder = FFI()
+ffibuilder.cdef(CDEF)
+ffibuilder.set_source(
+    "_unproject_avx2",
+    "#include <stdint.h>\n" + CDEF,
+    sources=[os.path.join(HERE, "unproject_avx2.c")],
+    extra_compile_args=["-O3"],
+)
+
+if __name__ == "__main__":
+    shutil.copy(ffibuilder.compile(tmpdir=os.path.join(HERE, "build"), verbose=True), HERE)
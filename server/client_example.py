@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 import asyncio
-import json
+import orjson
 import numpy as np
-import websockets
 import argparse
 from PIL import Image
-import open3d as o3d
 import sys
 import os
 import time
 
 # Add parent directory to path for imports if needed
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pointcloud import depth_to_point_cloud
+from protocol import DEFAULT_LIMS, connect, encode_request, encode_depth_request, decode_grasps, recv_grasp_stream
+
+# Camera intrinsics
+FX, FY = 927.17, 927.37
+CX, CY = 651.32, 349.62
+SCALE = 1000.0
 
 def process_depth_image(color_path, depth_path):
     """Process depth and color images to get point cloud data."""
@@ -19,23 +24,7 @@ def process_depth_image(color_path, depth_path):
     colors = np.array(Image.open(color_path), dtype=np.float32) / 255.0
     depths = np.array(Image.open(depth_path))
     
-    # Camera intrinsics
-    fx, fy = 927.17, 927.37
-    cx, cy = 651.32, 349.62
-    scale = 1000.0
-    
-    # Generate point cloud
-    xmap, ymap = np.arange(depths.shape[1]), np.arange(depths.shape[0])
-    xmap, ymap = np.meshgrid(xmap, ymap)
-    points_z = depths / scale
-    points_x = (xmap - cx) / fx * points_z
-    points_y = (ymap - cy) / fy * points_z
-    
-    # Filter valid points
-    mask = (points_z > 0) & (points_z < 1)
-    points = np.stack([points_x, points_y, points_z], axis=-1)
-    points = points[mask].astype(np.float32)
-    colors = colors[mask].astype(np.float32)
+    points, colors = depth_to_point_cloud(depths, colors, FX, FY, CX, CY, SCALE)
     
     return points, colors
 
@@ -64,33 +53,46 @@ def display_grasps(grasps):
     # Print all scores
     print(f"\nAll scores: {[round(grasp['score'], 4) for grasp in grasps]}")
 
-async def send_grasp_request(server_url, points, colors):
-    """Send point cloud data to the server and receive grasp results."""
-    async with websockets.connect(server_url) as ws:
-        # Prepare data to send
-        data = {
-            "points": points.tolist(),
-            "colors": colors.tolist(),
-            "lims": [-0.19, 0.12, 0.02, 0.15, 0.0, 1.0]  # Default workspace limits
-        }
-        
-        print(f"Sending point cloud data ({len(points)} points)...")
+async def send_grasp_request(server_url, data):
+    """Send an encoded request frame to the server and receive grasp results."""
+    async with connect(server_url) as ws:
+        print(f"Sending request ({len(data) / 1e6:.1f} MB)...")
         send_time = time.time()
         
         # Send the data
-        await ws.send(json.dumps(data))
+        await ws.send(data)
         
         # Receive the response
         response = await ws.recv()
         recv_time = time.time()
         
-        # Parse the response
-        result = json.loads(response)
+        # Errors come back as a JSON text frame, grasps as a binary frame
+        if isinstance(response, str):
+            raise RuntimeError(orjson.loads(response)["error"])
+        result = decode_grasps(response)
         
         print(f"Response received in {(recv_time - send_time):.2f} seconds")
         
         return result
 
+async def stream_grasp_request(server_url, data):
+    """Send an encoded request frame and receive the grasps one frame at a time."""
+    async with connect(f"{server_url}?stream=1") as ws:
+        print(f"Sending request ({len(data) / 1e6:.1f} MB)...")
+        send_time = time.time()
+        await ws.send(data)
+        
+        # Grasps arrive best first, so the top one is usable before the rest are in
+        result = []
+        async for grasp in recv_grasp_stream(ws):
+            if not result:
+                print(f"Best grasp received in {(time.time() - send_time):.2f} seconds")
+            result.append(grasp)
+        
+        print(f"Response received in {(time.time() - send_time):.2f} seconds")
+        
+        return result
+
 async def main():
     parser = argparse.ArgumentParser(description="AnyGrasp WebSocket Client Example")
     parser.add_argument("--server", type=str, default="ws://localhost:8000/ws/grasp",
@@ -99,25 +101,44 @@ async def main():
                         help="Path to color image")
     parser.add_argument("--depth", type=str, default="../grasp_detection/example_data/depth.png",
                         help="Path to depth image")
+    parser.add_argument("--send_images", action="store_true",
+                        help="Send the raw depth and color images and let the server unproject them on its GPU")
+    parser.add_argument("--stream", action="store_true",
+                        help="Receive the grasps one frame at a time, best first")
     args = parser.parse_args()
     
     print(f"Connecting to server: {args.server}")
     print(f"Processing images: {args.color} and {args.depth}")
     
-    # Process depth image to get point cloud
+    # Process depth image to get point cloud, or let the server unproject the raw images
     try:
-        points, colors = process_depth_image(args.color, args.depth)
-        print(f"Generated point cloud with {len(points)} points")
+        if args.send_images:
+            colors = np.array(Image.open(args.color))
+            depths = np.array(Image.open(args.depth))
+            data = encode_depth_request(depths, colors, FX, FY, CX, CY, SCALE, DEFAULT_LIMS)
+        else:
+            points, colors = process_depth_image(args.color, args.depth)
+            print(f"Generated point cloud with {len(points)} points")
+            data = encode_request(points, colors, DEFAULT_LIMS)
     except Exception as e:
         print(f"Error processing images: {str(e)}")
         return
     
     # Send data to server and get grasp results
     try:
-        result = await send_grasp_request(args.server, points, colors)
+        if args.stream:
+            result = await stream_grasp_request(args.server, data)
+        else:
+            result = await send_grasp_request(args.server, data)
         display_grasps(result)
     except Exception as e:
         print(f"Error communicating with server: {str(e)}")
 
 if __name__ == "__main__":
+    # uvloop cuts the asyncio overhead of sending and receiving large frames
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())
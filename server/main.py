@@ -1,7 +1,9 @@
 import os
 import sys
-import json
 import asyncio
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
@@ -13,7 +15,11 @@ from typing import List, Dict, Any
 # Add parent directory to path to import AnyGrasp
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from gsnet import AnyGrasp
-from graspnetAPI import GraspGroup
+from pointcloud import get_pixel_rays, get_max_depth, depth_to_point_cloud
+from protocol import (
+    GRASP_DTYPE, KIND_BATCH, KIND_DEPTH, decode_request, decode_depth_request,
+    encode_grasps, iter_grasp_frames, encode_batch, decode_batch, decode_json_request, encode_json_grasps
+)
 
 # Load environment variables
 load_dotenv()
@@ -38,19 +44,89 @@ class AnyGraspConfig:
         self.gripper_height = float(os.getenv("GRIPPER_HEIGHT", "0.03"))
         self.top_down_grasp = os.getenv("TOP_DOWN_GRASP", "false").lower() == "true"
         self.debug = os.getenv("DEBUG", "false").lower() == "true"
+        self.max_grasps = int(os.getenv("MAX_GRASPS", "100"))
 
 # Initialize AnyGrasp
 anygrasp = None
 
+# Inference runs on a single worker thread so it doesn't block the event loop;
+# one worker because the model isn't thread-safe and there is a single GPU
+INFER_POOL = ThreadPoolExecutor(max_workers=1)
+
+# Per-thread float32 buffers that compact requests are decoded into, grown
+# geometrically so a steady stream of requests stops allocating
+_scratch = threading.local()
+
+def scratch_buffer(name, num_points):
+    """Return an (num_points, 3) float32 view of this thread's scratch buffer `name`."""
+    buf = getattr(_scratch, name, None)
+    if buf is None or len(buf) < num_points:
+        buf = np.empty((max(num_points, 2 * (0 if buf is None else len(buf))), 3), dtype=np.float32)
+        setattr(_scratch, name, buf)
+    return buf[:num_points]
+
+@lru_cache(maxsize=8)
+def get_gpu_pixel_rays(height, width, fx, fy, cx, cy):
+    """Return pointcloud.get_pixel_rays on the GPU, cached the same way."""
+    return tuple(torch.from_numpy(r).to("cuda") for r in get_pixel_rays(height, width, fx, fy, cx, cy))
+
+def unproject_depth(depths, colors, fx, fy, cx, cy, scale):
+    """Unproject a uint16 depth image (and uint8 colors) into float32 points and colors.
+
+    Runs with torch on the GPU next to the model when CUDA is available,
+    otherwise on the CPU with pointcloud.depth_to_point_cloud.
+    """
+    if not torch.cuda.is_available():
+        colors = np.full(depths.shape + (3,), 0.5, dtype=np.float32) if colors is None else colors / np.float32(255)
+        return depth_to_point_cloud(depths, colors, fx, fy, cx, cy, scale)
+
+    device = torch.device("cuda")
+    u_norm, v_norm = get_gpu_pixel_rays(depths.shape[0], depths.shape[1], fx, fy, cx, cy)
+
+    # torch has no uint16, so upload the raw bits as int16 and widen them on the GPU
+    depths_t = torch.tensor(depths.view(np.int16), device=device).int() & 0xFFFF
+    mask = (depths_t > 0) & (depths_t < get_max_depth(depths, scale))
+    vs, us = mask.nonzero(as_tuple=True)
+    points_z = depths_t[mask].float() * (1.0 / scale)
+    points = torch.stack([u_norm[us] * points_z, v_norm[vs] * points_z, points_z], dim=1)
+    if colors is None:
+        colors_t = torch.full_like(points, 0.5)
+    else:
+        colors_t = torch.tensor(colors, device=device)[mask].float() * (1.0 / 255)
+
+    # AnyGrasp.get_grasp takes NumPy arrays, so the cloud comes back to the host once
+    return points.cpu().numpy(), colors_t.cpu().numpy()
+
+def decode_frame(buf):
+    """Decode a point cloud or depth request frame into float32 (points, colors, lims).
+
+    Requests are decoded on INFER_POOL right before inference, so the single
+    worker thread never overwrites a scratch buffer that is still in use.
+    """
+    if buf[0] == KIND_DEPTH:
+        depths, colors, intrinsics, lims = decode_depth_request(buf)
+        points, colors = unproject_depth(depths, colors, *intrinsics)
+        return points, colors, lims
+    return decode_request(buf, alloc=scratch_buffer)
+
+# Pending requests are queued and drained in batches by inference_worker
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+request_queue = None
+inference_task = None
+
 @app.on_event("startup")
 async def startup_event():
-    global anygrasp
+    global anygrasp, request_queue, inference_task
     config = AnyGraspConfig()
+    app.state.config = config
     print(f"Initializing AnyGrasp with checkpoint: {config.checkpoint_path}")
     anygrasp = AnyGrasp(config)
     anygrasp.load_net()
     print("AnyGrasp initialization complete")
 
+    request_queue = asyncio.Queue()
+    inference_task = asyncio.create_task(inference_worker())
+
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
@@ -72,6 +148,14 @@ class ConnectionManager:
     async def send_json(self, data: Dict[str, Any], websocket: WebSocket):
         await websocket.send_json(data)
 
+    async def broadcast_bytes(self, data: bytes):
+        # Encode once, send the same bytes to every client; one failed send
+        # doesn't stop the others, its handler cleans up on disconnect
+        await asyncio.gather(
+            *(websocket.send_bytes(data) for websocket in list(self.active_connections)),
+            return_exceptions=True
+        )
+
 manager = ConnectionManager()
 
 def process_grasp(points, colors, lims):
@@ -95,52 +179,105 @@ def process_grasp(points, colors, lims):
     return gg, cloud
 
 def prepare_grasp_data(gg, max_grasps=20):
-    """Extract only grasp data for transmission."""
+    """Extract only grasp data for transmission, as a GRASP_DTYPE array."""
     if len(gg) == 0:
-        return []
+        return np.empty(0, dtype=GRASP_DTYPE)
     
     # Get top grasps sorted by score
     gg_pick = gg[0:max_grasps]
     
-    # Extract the grasp parameters (similar to how they're displayed in the demo)
-    grasp_list = []
-    for g in gg_pick:
-        grasp_dict = {
-            "score": float(g.score),
-            "width": float(g.width),
-            "height": float(g.height) if hasattr(g, 'height') else float(0.03),
-            "depth": float(g.depth),
-            "translation": g.translation.tolist(),
-            "rotation_matrix": g.rotation_matrix.tolist(),
-            "object_id": int(g.object_id) if hasattr(g, 'object_id') else -1
-        }
-        grasp_list.append(grasp_dict)
+    # Copy the grasp parameters column by column (similar to how they're displayed in the demo)
+    grasps = np.empty(len(gg_pick), dtype=GRASP_DTYPE)
+    grasps["score"] = gg_pick.scores
+    grasps["width"] = gg_pick.widths
+    grasps["height"] = gg_pick.heights if hasattr(gg_pick, 'heights') else 0.03
+    grasps["depth"] = gg_pick.depths
+    grasps["translation"] = gg_pick.translations
+    grasps["rotation_matrix"] = gg_pick.rotation_matrices.reshape(-1, 3, 3)
+    grasps["object_id"] = gg_pick.object_ids if hasattr(gg_pick, 'object_ids') else -1
+    
+    return grasps
+
+def detect_grasps(data, decode, encode, max_grasps):
+    """Decode a request, run grasp detection and encode the top grasps. Runs on INFER_POOL."""
+    points, colors, lims = decode(data)
     
-    return grasp_list
+    # We only need the grasp data, not the point cloud
+    gg, cloud = process_grasp(points, colors, lims)
+    return encode(prepare_grasp_data(gg, max_grasps))
+
+def run_batch(batch):
+    """Run detect_grasps for every request of a batch, returning results or exceptions."""
+    # AnyGrasp has no batched API, so requests run back to back on the warm model
+    results = []
+    for args in batch:
+        try:
+            results.append(detect_grasps(*args))
+        except Exception as e:
+            results.append(e)
+    return results
+
+async def inference_worker():
+    """Drain request_queue in batches of up to MAX_BATCH_SIZE and run them on INFER_POOL."""
+    loop = asyncio.get_running_loop()
+    while True:
+        # Wait for one request, then take whatever else queued up during the last batch
+        items = [await request_queue.get()]
+        try:
+            while len(items) < MAX_BATCH_SIZE:
+                items.append(request_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            pass
+
+        results = await loop.run_in_executor(INFER_POOL, run_batch, [args for args, _ in items])
+        for (_, future), result in zip(items, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+async def submit_request(*args):
+    """Queue detect_grasps(*args) for inference_worker and wait for its response frame."""
+    future = asyncio.get_running_loop().create_future()
+    await request_queue.put((args, future))
+    return await future
 
 @app.websocket("/ws/grasp")
 async def grasp_websocket(websocket: WebSocket):
     await manager.connect(websocket)
+    max_grasps = app.state.config.max_grasps
+    # With ?stream=1 binary requests are answered one grasp per frame, so the
+    # client can act on the best grasp while the rest are still being sent
+    stream = websocket.query_params.get("stream") == "1"
     try:
         while True:
-            # Receive the input data
-            data = await websocket.receive_json()
-            
-            # Extract input parameters
-            points = np.array(data["points"], dtype=np.float32)
-            colors = np.array(data["colors"], dtype=np.float32)
-            
-            # Get workspace limits
-            lims = data.get("lims", [-0.19, 0.12, 0.02, 0.15, 0.0, 1.0])
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
             
-            # Process grasp detection
-            gg, cloud = process_grasp(points, colors, lims)
-            
-            # We only need the grasp data, not the point cloud
-            max_grasps = int(os.getenv("MAX_GRASPS", "100"))
-            result = prepare_grasp_data(gg, max_grasps)
-            
-            await manager.send_json(result, websocket)
+            # Decode and process grasp detection off the event loop
+            data = message.get("bytes")
+            if data is not None and data[:1] == bytes([KIND_BATCH]):
+                # Requests of a batch frame are queued together and answered in one batch frame
+                results = await asyncio.gather(
+                    *(submit_request(frame, decode_frame, encode_grasps, max_grasps) for frame in decode_batch(data)),
+                    return_exceptions=True
+                )
+                await manager.send_bytes(encode_batch(results), websocket)
+            elif data is not None:
+                result = await submit_request(data, decode_frame, encode_grasps, max_grasps)
+                if stream:
+                    for frame in iter_grasp_frames(result):
+                        await manager.send_bytes(frame, websocket)
+                    await manager.send_bytes(b"", websocket)
+                else:
+                    await manager.send_bytes(result, websocket)
+            else:
+                # JSON requests are still accepted and answered with JSON
+                result = await submit_request(message["text"], decode_json_request, encode_json_grasps, max_grasps)
+                await manager.send_message(result, websocket)
             
     except WebSocketDisconnect:
         manager.disconnect(websocket)
@@ -173,4 +310,17 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     
     print(f"Starting server on {host}:{port}")
-    uvicorn.run("main:app", host=host, port=port, reload=True)
+    # Point clouds compress poorly, so skip permessage-deflate and allow
+    # frames larger than the 16 MB default for full-resolution clouds
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        reload=True,
+        backlog=2048,
+        timeout_keep_alive=75,
+        loop="uvloop",
+        ws="websockets",
+        ws_per_message_deflate=False,
+        ws_max_size=int(os.getenv("WS_MAX_SIZE", str(64 * 1024 * 1024))),
+    )
@@ -0,0 +1,140 @@
+import functools
+import math
+import os
+import numpy as np
+
+# The AVX2 extension (see build_unproject.py) is optional; without it the
+# unprojection runs in NumPy, or in Numba if opted in with UNPROJECT_NUMBA=1
+try:
+    from _unproject_avx2 import ffi as _avx2_ffi, lib as _avx2_lib
+    HAS_AVX2 = bool(_avx2_lib.unproject_has_avx2())
+except ImportError:
+    HAS_AVX2 = False
+
+# Intrinsics and image size are fixed for a camera, so the normalized pixel rays
+# are computed once, not every frame. The cache is bounded since the server
+# builds rays for whatever intrinsics its clients send.
+@functools.lru_cache(maxsize=8)
+def get_pixel_rays(height, width, fx, fy, cx, cy):
+    """Return the cached (u_norm, v_norm) rays for the given image size and intrinsics."""
+    u_norm = (np.arange(width, dtype=np.float32) - cx) / fx
+    v_norm = (np.arange(height, dtype=np.float32) - cy) / fy
+    return u_norm, v_norm
+
+@functools.lru_cache(maxsize=None)
+def _get_numba_kernel():
+    """Compile the Numba kernel on first use, or return None if not opted in or Numba is missing.
+
+    Importing and loading the kernel takes a few hundred ms (seconds if its
+    cache is cold), more than NumPy takes for a whole frame, so it only pays
+    off for processes unprojecting many frames.
+    """
+    if os.getenv("UNPROJECT_NUMBA", "0") != "1":
+        return None
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _unproject_kernel(depths, max_depth, inv_scale, u_norm, v_norm):
+        """Fused mask + unproject + pack over the image rows, in parallel."""
+        height, width = depths.shape
+
+        # First pass counts the valid pixels of each row
+        row_counts = np.zeros(height + 1, dtype=np.int64)
+        for v in prange(height):
+            count = 0
+            for u in range(width):
+                d = depths[v, u]
+                if d > 0 and d < max_depth:
+                    count += 1
+            row_counts[v + 1] = count
+        row_offsets = np.cumsum(row_counts)
+
+        # Second pass writes each row's points at its offset, so the output is already compact
+        points = np.empty((row_offsets[height], 3), dtype=np.float32)
+        pixel_idx = np.empty(row_offsets[height], dtype=np.int64)
+        for v in prange(height):
+            i = row_offsets[v]
+            for u in range(width):
+                d = depths[v, u]
+                if d > 0 and d < max_depth:
+                    z = d * inv_scale
+                    points[i, 0] = u_norm[u] * z
+                    points[i, 1] = v_norm[v] * z
+                    points[i, 2] = z
+                    pixel_idx[i] = v * width + u
+                    i += 1
+        return points, pixel_idx
+
+    return _unproject_kernel
+
+def _unproject_avx2(depths, max_depth, inv_scale, u_norm, v_norm):
+    """Run the AVX2 kernel on a uint16 depth image; returns (points, flat pixel indices)."""
+    depths = np.ascontiguousarray(depths)
+    height, width = depths.shape
+    depths_ptr = _avx2_ffi.from_buffer("uint16_t[]", depths)
+    count = _avx2_lib.unproject_count_u16(depths_ptr, height, width, max_depth)
+
+    points = np.empty((count, 3), dtype=np.float32)
+    pixel_idx = np.empty(count, dtype=np.int64)
+    _avx2_lib.unproject_u16(
+        depths_ptr, height, width, max_depth, inv_scale,
+        _avx2_ffi.from_buffer("float[]", u_norm),
+        _avx2_ffi.from_buffer("float[]", v_norm),
+        _avx2_ffi.from_buffer("float[]", points, require_writable=True),
+        _avx2_ffi.from_buffer("int64_t[]", pixel_idx, require_writable=True),
+    )
+    return points, pixel_idx
+
+def get_max_depth(depths, scale):
+    """Exclusive limit for 0 < depth < 1m in the depth image's own units.
+
+    For integer depth images this is an integer, so the valid mask is computed
+    on the raw depths without converting them to float first. If 1m is beyond
+    the dtype's range the limit is one past its max, so every nonzero depth is
+    valid; all unprojection paths compare in a wider type than the depths.
+    """
+    if depths.dtype.kind not in "iu":
+        return scale
+    return min(math.ceil(scale), int(np.iinfo(depths.dtype).max) + 1)
+
+def depth_to_point_cloud(depths, colors, fx, fy, cx, cy, scale):
+    """Unproject a depth image into an (N, 3) float32 point cloud with matching colors.
+
+    Only pixels with 0 < depth < 1m are kept, same as in demo.py.
+    """
+    u_norm, v_norm = get_pixel_rays(depths.shape[0], depths.shape[1], fx, fy, cx, cy)
+    max_depth = get_max_depth(depths, scale)
+
+    if HAS_AVX2 and depths.dtype == np.uint16:
+        points, pixel_idx = _unproject_avx2(depths, max_depth, 1.0 / scale, u_norm, v_norm)
+        return points, colors.reshape(-1, colors.shape[-1])[pixel_idx]
+
+    unproject_kernel = _get_numba_kernel()
+    if unproject_kernel is not None:
+        points, pixel_idx = unproject_kernel(depths, max_depth, np.float32(1.0 / scale), u_norm, v_norm)
+        return points, colors.reshape(-1, colors.shape[-1])[pixel_idx]
+
+    # Mask first on the raw depths, then convert and unproject only the valid pixels
+    mask = (depths > 0) & (depths < max_depth)
+    vs, us = np.nonzero(mask)
+    points_z = depths[mask].astype(np.float32) * (1.0 / scale)
+    points = np.empty((points_z.size, 3), dtype=np.float32)
+    points[:, 0] = u_norm[us] * points_z
+    points[:, 1] = v_norm[vs] * points_z
+    points[:, 2] = points_z
+
+    return points, colors[vs, us]
+
+def voxel_downsample(points, colors, voxel_size):
+    """Keep one point (and its color) per occupied voxel of a voxel_size grid."""
+    if len(points) == 0:
+        return points, colors
+    keys = np.floor(points * (1.0 / voxel_size)).astype(np.int64)
+    keys -= keys.min(axis=0)
+    # Linearize the 3-D voxel coordinates so np.unique sorts plain int64 keys
+    voxel_ids = np.ravel_multi_index(keys.T, keys.max(axis=0) + 1)
+    _, indices = np.unique(voxel_ids, return_index=True)
+    return points[indices], colors[indices]
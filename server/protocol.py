@@ -0,0 +1,280 @@
+import asyncio
+import struct
+import numpy as np
+import orjson
+import websockets
+
+# The first byte of every binary request frame is its kind
+KIND_POINTS = 1
+KIND_BATCH = 2
+KIND_DEPTH = 3
+
+# Request frame: header, then the raw (N, 3) points and colors buffers.
+# Header fields: kind, points dtype, colors dtype, number of points, workspace limits.
+REQUEST_HEADER = struct.Struct("<BBBxI6f")
+
+# Depth frame: header, then the raw (H, W) uint16 depth image and, if present,
+# the (H, W, 3) uint8 color image, for the server to unproject itself.
+# Header fields: kind, has colors, height, width, fx, fy, cx, cy, scale, workspace limits.
+DEPTH_HEADER = struct.Struct("<BBxxII5f6f")
+
+# Batch frame: header with the kind and record count, then one record header
+# (status, length) and payload per request frame. Batch responses use the same
+# layout with one response frame, or an error message, per request.
+BATCH_HEADER = struct.Struct("<BxxxI")
+RECORD_HEADER = struct.Struct("<BxxxI")
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# Dtype codes used in the request header. Points default to float16 (sub-mm
+# precision within the 1m working range) and colors to the original 8-bit values.
+WIRE_DTYPES = [np.dtype(np.float32), np.dtype(np.float16), np.dtype(np.uint8)]
+
+# One grasp of the response frame; the frame is the raw bytes of a GRASP_DTYPE array.
+# Streamed responses (ws://.../ws/grasp?stream=1) instead send one frame per grasp,
+# best first, followed by an empty frame.
+GRASP_DTYPE = np.dtype([
+    ("score", "<f4"),
+    ("width", "<f4"),
+    ("height", "<f4"),
+    ("depth", "<f4"),
+    ("translation", "<f4", (3,)),
+    ("rotation_matrix", "<f4", (3, 3)),
+    ("object_id", "<i4"),
+])
+
+# Default workspace limits [xmin, xmax, ymin, ymax, zmin, zmax]
+DEFAULT_LIMS = [-0.19, 0.12, 0.02, 0.15, 0.0, 1.0]
+
+def connect(url, **kwargs):
+    """Open a websockets client connection with compression off.
+
+    The socket needs no further tuning: asyncio and uvloop transports already
+    set TCP_NODELAY, and Linux autotunes the send buffer for large frames.
+    """
+    return websockets.connect(url, compression=None, **kwargs)
+
+def encode_request(points, colors, lims=None, compact=True):
+    """Pack a point cloud and its workspace limits into a binary request frame.
+
+    colors are floats in [0, 1]. With compact=True points are sent as float16
+    and colors as uint8, otherwise both are sent as float32.
+    """
+    if lims is None:
+        lims = DEFAULT_LIMS
+    if compact:
+        points = np.ascontiguousarray(points, dtype=np.float16)
+        colors = np.rint(np.multiply(colors, 255, dtype=np.float32)).astype(np.uint8)
+    else:
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        colors = np.ascontiguousarray(colors, dtype=np.float32)
+    header = REQUEST_HEADER.pack(
+        KIND_POINTS, WIRE_DTYPES.index(points.dtype), WIRE_DTYPES.index(colors.dtype), len(points), *lims
+    )
+    return b"".join([header, points, colors])
+
+def _float32_buffer(alloc, name, num_points):
+    if alloc is None:
+        return np.empty((num_points, 3), dtype=np.float32)
+    return alloc(name, num_points)
+
+def decode_request(buf, alloc=None):
+    """Unpack a binary request frame into float32 (points, colors, lims).
+
+    Arrays sent as float32 are zero-copy views into buf. Arrays that need
+    converting are written into alloc(name, num_points), an (N, 3) float32
+    buffer the caller may reuse across requests, or a fresh array if alloc is None.
+    """
+    kind, points_code, colors_code, num_points, *lims = REQUEST_HEADER.unpack_from(buf)
+    if kind != KIND_POINTS:
+        raise ValueError(f"Unexpected request frame kind {kind}")
+    points_dtype, colors_dtype = WIRE_DTYPES[points_code], WIRE_DTYPES[colors_code]
+    expected = REQUEST_HEADER.size + 3 * num_points * (points_dtype.itemsize + colors_dtype.itemsize)
+    if len(buf) != expected:
+        raise ValueError(f"Malformed request frame: expected {expected} bytes, got {len(buf)}")
+
+    offset = REQUEST_HEADER.size
+    points = np.frombuffer(buf, dtype=points_dtype, count=3 * num_points, offset=offset).reshape(num_points, 3)
+    offset += points.nbytes
+    colors = np.frombuffer(buf, dtype=colors_dtype, count=3 * num_points, offset=offset).reshape(num_points, 3)
+
+    if points_dtype != np.float32:
+        out = _float32_buffer(alloc, "points", num_points)
+        np.copyto(out, points)
+        points = out
+    if colors_dtype == np.uint8:
+        out = _float32_buffer(alloc, "colors", num_points)
+        np.multiply(colors, np.float32(1 / 255), out=out)
+        colors = out
+    elif colors_dtype != np.float32:
+        out = _float32_buffer(alloc, "colors", num_points)
+        np.copyto(out, colors)
+        colors = out
+
+    return points, colors, lims
+
+def encode_depth_request(depths, colors, fx, fy, cx, cy, scale, lims=None):
+    """Pack a uint16 depth image, an optional uint8 color image and the camera intrinsics into a depth frame."""
+    if lims is None:
+        lims = DEFAULT_LIMS
+    depths = np.ascontiguousarray(depths, dtype=np.uint16)
+    height, width = depths.shape
+    parts = [DEPTH_HEADER.pack(KIND_DEPTH, colors is not None, height, width, fx, fy, cx, cy, scale, *lims), depths]
+    if colors is not None:
+        parts.append(np.ascontiguousarray(colors, dtype=np.uint8).reshape(height, width, 3))
+    return b"".join(parts)
+
+def decode_depth_request(buf):
+    """Unpack a depth frame into (depths, colors, (fx, fy, cx, cy, scale), lims).
+
+    depths and colors are zero-copy views into buf; colors is None if not sent.
+    """
+    kind, has_colors, height, width, *params = DEPTH_HEADER.unpack_from(buf)
+    if kind != KIND_DEPTH:
+        raise ValueError(f"Unexpected request frame kind {kind}")
+    intrinsics, lims = params[:5], params[5:]
+    expected = DEPTH_HEADER.size + height * width * (2 + (3 if has_colors else 0))
+    if len(buf) != expected:
+        raise ValueError(f"Malformed depth frame: expected {expected} bytes, got {len(buf)}")
+
+    offset = DEPTH_HEADER.size
+    depths = np.frombuffer(buf, dtype=np.uint16, count=height * width, offset=offset).reshape(height, width)
+    colors = None
+    if has_colors:
+        offset += depths.nbytes
+        colors = np.frombuffer(buf, dtype=np.uint8, count=height * width * 3, offset=offset).reshape(height, width, 3)
+
+    return depths, colors, tuple(intrinsics), lims
+
+def encode_batch(records, kind=KIND_BATCH):
+    """Pack request or response frames into one batch frame.
+
+    Exceptions among records are sent as error messages.
+    """
+    parts = [BATCH_HEADER.pack(kind, len(records))]
+    for record in records:
+        if isinstance(record, Exception):
+            message = str(record).encode()
+            parts += [RECORD_HEADER.pack(STATUS_ERROR, len(message)), message]
+        else:
+            parts += [RECORD_HEADER.pack(STATUS_OK, len(record)), record]
+    return b"".join(parts)
+
+def decode_batch(buf):
+    """Unpack a batch frame into its records.
+
+    Records are zero-copy memoryviews into buf; error records become RuntimeError.
+    """
+    buf = memoryview(buf)
+    kind, count = BATCH_HEADER.unpack_from(buf)
+    offset = BATCH_HEADER.size
+    records = []
+    for _ in range(count):
+        status, length = RECORD_HEADER.unpack_from(buf, offset)
+        offset += RECORD_HEADER.size
+        record = buf[offset:offset + length]
+        if len(record) != length:
+            raise ValueError(f"Malformed batch frame: record truncated at byte {offset}")
+        offset += length
+        records.append(record if status == STATUS_OK else RuntimeError(bytes(record).decode()))
+    return records
+
+class RequestBatcher:
+    """Merge requests submitted within flush_ms of each other into one batch frame.
+
+    Use as `async with RequestBatcher(ws) as batcher`, then `await batcher.submit(frame)`
+    from any number of tasks; each call returns that request's response frame.
+    """
+    def __init__(self, ws, max_batch=8, flush_ms=5.0):
+        self.ws = ws
+        self.max_batch = max_batch
+        self.flush_ms = flush_ms
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(self.run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.task.cancel()
+
+    async def submit(self, frame):
+        """Queue an encoded request frame and wait for its response frame."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((frame, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for one request, then for more until the batch is full or flush_ms passed
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.flush_ms / 1000
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self.ws.send(encode_batch([frame for frame, _ in items]))
+                response = await self.ws.recv()
+                if isinstance(response, str):
+                    raise RuntimeError(orjson.loads(response)["error"])
+                results = decode_batch(response)
+                if len(results) != len(items):
+                    raise RuntimeError(f"Expected {len(items)} responses in batch, got {len(results)}")
+            except Exception as e:
+                results = [e] * len(items)
+
+            for (_, future), result in zip(items, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(bytes(result))
+
+def iter_grasp_frames(buf):
+    """Split a binary response frame into one frame per grasp, for streamed responses."""
+    step = GRASP_DTYPE.itemsize
+    return [buf[offset:offset + step] for offset in range(0, len(buf), step)]
+
+async def recv_grasp_stream(ws):
+    """Yield grasp dicts from a streamed response, best first, until its empty end frame."""
+    while True:
+        frame = await ws.recv()
+        if isinstance(frame, str):
+            raise RuntimeError(orjson.loads(frame)["error"])
+        if len(frame) == 0:
+            return
+        for grasp in decode_grasps(frame):
+            yield grasp
+
+def grasps_to_dicts(grasps):
+    """Convert a GRASP_DTYPE array into a list of grasp dicts."""
+    fields = [grasps[name].tolist() for name in GRASP_DTYPE.names]
+    return [dict(zip(GRASP_DTYPE.names, values)) for values in zip(*fields)]
+
+def encode_grasps(grasps):
+    """Pack a GRASP_DTYPE array into a binary response frame."""
+    return np.ascontiguousarray(grasps, dtype=GRASP_DTYPE).tobytes()
+
+def decode_grasps(buf):
+    """Unpack a binary response frame into a list of grasp dicts."""
+    return grasps_to_dicts(np.frombuffer(buf, dtype=GRASP_DTYPE))
+
+def decode_json_request(text):
+    """Unpack a JSON request {"points", "colors", "lims"} from clients that don't speak the binary frames."""
+    data = orjson.loads(text)
+    points = np.asarray(data["points"], dtype=np.float32)
+    colors = np.asarray(data["colors"], dtype=np.float32)
+    return points, colors, data.get("lims", DEFAULT_LIMS)
+
+def encode_json_grasps(grasps):
+    """Serialize a GRASP_DTYPE array as a JSON list of grasp dicts."""
+    return orjson.dumps(grasps_to_dicts(grasps)).decode()
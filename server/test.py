@@ -2,17 +2,18 @@
 import os
 import sys
 import asyncio
-import json
+import orjson
 import numpy as np
-import websockets
 import argparse
 from PIL import Image
 import time
 
 # Add parent directory to path for imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pointcloud import depth_to_point_cloud, voxel_downsample
+from protocol import DEFAULT_LIMS, RequestBatcher, connect, encode_request, decode_grasps
 
-def process_depth_image(data_dir, downsample_factor=10):
+def process_depth_image(data_dir, voxel_size=0.003):
     """Process depth and color images to get point cloud data, same as in demo.py."""
     # Get data
     color_path = os.path.join(data_dir, 'color.png')
@@ -26,29 +27,17 @@ def process_depth_image(data_dir, downsample_factor=10):
     cx, cy = 651.32, 349.62
     scale = 1000.0
     
-    # Get point cloud - same algorithm as in demo.py
-    xmap, ymap = np.arange(depths.shape[1]), np.arange(depths.shape[0])
-    xmap, ymap = np.meshgrid(xmap, ymap)
-    points_z = depths / scale
-    points_x = (xmap - cx) / fx * points_z
-    points_y = (ymap - cy) / fy * points_z
-    
-    # Filter points
-    mask = (points_z > 0) & (points_z < 1)
-    points = np.stack([points_x, points_y, points_z], axis=-1)
-    points = points[mask].astype(np.float32)
-    colors = colors[mask].astype(np.float32)
+    points, colors = depth_to_point_cloud(depths, colors, fx, fy, cx, cy, scale)
     
     original_size = len(points)
     print(f"Original point cloud: {original_size} points")
     print(f"Point cloud bounds: {points.min(axis=0)} to {points.max(axis=0)}")
     
-    # Downsample the point cloud to reduce size for WebSocket transmission
-    if downsample_factor > 1:
-        indices = np.random.choice(len(points), len(points) // downsample_factor, replace=False)
-        points = points[indices]
-        colors = colors[indices]
-        print(f"Downsampled point cloud: {len(points)} points (1/{downsample_factor} of original)")
+    # Downsample the point cloud to reduce size for WebSocket transmission,
+    # keeping one point per voxel for even spatial coverage
+    if voxel_size > 0:
+        points, colors = voxel_downsample(points, colors, voxel_size)
+        print(f"Downsampled point cloud: {len(points)} points (voxel size {voxel_size}m)")
     
     return points, colors
 
@@ -84,31 +73,29 @@ async def test_grasp_server(server_url, points, colors, workspace_limits=None):
     print(f"Connecting to server at {server_url}...")
     
     try:
-        async with websockets.connect(server_url) as ws:
+        async with connect(server_url) as ws:
             # Set default workspace limits if none provided
             if workspace_limits is None:
-                workspace_limits = [-0.19, 0.12, 0.02, 0.15, 0.0, 1.0]
+                workspace_limits = DEFAULT_LIMS
             
-            # Prepare data to send
-            data = {
-                "points": points.tolist(),
-                "colors": colors.tolist(),
-                "lims": workspace_limits
-            }
+            # Pack the point cloud into a binary frame
+            data = encode_request(points, colors, workspace_limits)
             
-            print(f"Sending point cloud with {len(points)} points...")
+            print(f"Sending point cloud with {len(points)} points ({len(data) / 1e6:.1f} MB)...")
             start_time = time.time()
             
             # Send the data
-            await ws.send(json.dumps(data))
+            await ws.send(data)
             print("Data sent, waiting for response...")
             
             # Receive the response
             response = await ws.recv()
             end_time = time.time()
             
-            # Parse the response
-            grasps = json.loads(response)
+            # Errors come back as a JSON text frame, grasps as a binary frame
+            if isinstance(response, str):
+                raise RuntimeError(orjson.loads(response)["error"])
+            grasps = decode_grasps(response)
             
             print(f"Response received in {(end_time - start_time):.2f} seconds")
             display_grasps(grasps)
@@ -118,6 +105,30 @@ async def test_grasp_server(server_url, points, colors, workspace_limits=None):
         print(f"Error communicating with server: {str(e)}")
         return []
 
+async def test_batched_requests(server_url, points, colors, num_requests, workspace_limits=None):
+    """Test the grasp server by sending several requests at once, merged into one batch frame."""
+    print(f"Connecting to server at {server_url}...")
+    
+    try:
+        async with connect(server_url) as ws, RequestBatcher(ws, max_batch=num_requests) as batcher:
+            data = encode_request(points, colors, workspace_limits)
+            
+            print(f"Sending {num_requests} requests with {len(points)} points each in one batch...")
+            start_time = time.time()
+            
+            # Concurrent submissions are merged by the batcher into a single frame
+            responses = await asyncio.gather(*(batcher.submit(data) for _ in range(num_requests)))
+            end_time = time.time()
+            
+            print(f"{num_requests} responses received in {(end_time - start_time):.2f} seconds")
+            grasps = decode_grasps(responses[0])
+            display_grasps(grasps)
+            
+            return grasps
+    except Exception as e:
+        print(f"Error communicating with server: {str(e)}")
+        return []
+
 async def main():
     parser = argparse.ArgumentParser(description="Test AnyGrasp WebSocket Server")
     parser.add_argument("--host", type=str, default="localhost",
@@ -126,8 +137,10 @@ async def main():
                         help="Port of the AnyGrasp server")
     parser.add_argument("--data_dir", type=str, default="../grasp_detection/example_data",
                         help="Directory containing example color.png and depth.png")
-    parser.add_argument("--downsample", type=int, default=10,
-                        help="Downsample factor to reduce point cloud size (higher = smaller data)")
+    parser.add_argument("--voxel_size", type=float, default=0.003,
+                        help="Voxel size in meters to downsample the point cloud (higher = smaller data, 0 = off)")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="Number of requests to send at once, merged into one batch frame")
     parser.add_argument("--save_result", action="store_true",
                         help="Save the grasp results to a JSON file")
     args = parser.parse_args()
@@ -145,20 +158,29 @@ async def main():
     
     # Process example depth and color images
     try:
-        points, colors = process_depth_image(args.data_dir, args.downsample)
+        points, colors = process_depth_image(args.data_dir, args.voxel_size)
     except Exception as e:
         print(f"Error processing images: {str(e)}")
         return
     
     # Test the server
-    grasps = await test_grasp_server(ws_url, points, colors)
+    if args.batch > 1:
+        grasps = await test_batched_requests(ws_url, points, colors, args.batch)
+    else:
+        grasps = await test_grasp_server(ws_url, points, colors)
     
     # Save results if requested
     if args.save_result and grasps:
         output_file = "grasp_results.json"
-        with open(output_file, "w") as f:
-            json.dump(grasps, f, indent=2)
+        with open(output_file, "wb") as f:
+            f.write(orjson.dumps(grasps, option=orjson.OPT_INDENT_2))
         print(f"Saved grasp results to {output_file}")
 
 if __name__ == "__main__":
+    # uvloop cuts the asyncio overhead of sending and receiving large frames
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())
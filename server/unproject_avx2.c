@@ -0,0 +1,150 @@
+/*
+ * Depth image unprojection for pointcloud.py, vectorized with AVX2.
+ * Build with build_unproject.py. On CPUs (or architectures) without AVX2,
+ * unproject_has_avx2() returns 0 and pointcloud.py falls back to Numba/NumPy.
+ */
+#include <stdint.h>
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <immintrin.h>
+#define UNPROJECT_X86 1
+#endif
+
+int unproject_has_avx2(void)
+{
+#if defined(UNPROJECT_X86) && defined(__GNUC__)
+    __builtin_cpu_init();
+    return __builtin_cpu_supports("avx2");
+#else
+    return 0;
+#endif
+}
+
+#ifdef UNPROJECT_X86
+
+/* Bitmask of the lanes with 0 < d < max_depth. */
+__attribute__((target("avx2")))
+static inline int valid_lanes(__m256i d, __m256i max_depth)
+{
+    __m256i valid = _mm256_and_si256(_mm256_cmpgt_epi32(d, _mm256_setzero_si256()),
+                                     _mm256_cmpgt_epi32(max_depth, d));
+    return _mm256_movemask_ps(_mm256_castsi256_ps(valid));
+}
+
+/* Count the pixels with 0 < depth < max_depth, so the caller can size the output exactly. */
+__attribute__((target("avx2")))
+int64_t unproject_count_u16(const uint16_t *depths, int64_t height, int64_t width, uint32_t max_depth)
+{
+    const __m256i max_v = _mm256_set1_epi32((int32_t)max_depth);
+    const int64_t n = height * width;
+    int64_t count = 0;
+    int64_t i = 0;
+
+    for (; i + 16 <= n; i += 16) {
+        __m256i d16 = _mm256_loadu_si256((const __m256i *)(depths + i));
+        __m256i lo = _mm256_cvtepu16_epi32(_mm256_castsi256_si128(d16));
+        __m256i hi = _mm256_cvtepu16_epi32(_mm256_extracti128_si256(d16, 1));
+        count += __builtin_popcount(valid_lanes(lo, max_v)) + __builtin_popcount(valid_lanes(hi, max_v));
+    }
+    for (; i < n; i++)
+        count += depths[i] > 0 && depths[i] < max_depth;
+    return count;
+}
+
+/*
+ * Write xyz of the 8 pixels starting at column u of row v into out_xyz and
+ * their flat indices into out_idx, skipping invalid lanes. Returns the
+ * number of points written.
+ */
+__attribute__((target("avx2")))
+static inline int64_t unproject_lanes(__m256i d, __m256i max_v, __m256 inv_scale, __m256 v_ray,
+                                      const float *u_norm, int64_t v, int64_t u, int64_t width,
+                                      float *out_xyz, int64_t *out_idx)
+{
+    int bits = valid_lanes(d, max_v);
+    if (bits == 0)
+        return 0;
+
+    __m256 z = _mm256_mul_ps(_mm256_cvtepi32_ps(d), inv_scale);
+    __m256 x = _mm256_mul_ps(_mm256_loadu_ps(u_norm + u), z);
+    __m256 y = _mm256_mul_ps(v_ray, z);
+
+    float xs[8], ys[8], zs[8];
+    _mm256_storeu_ps(xs, x);
+    _mm256_storeu_ps(ys, y);
+    _mm256_storeu_ps(zs, z);
+
+    int64_t written = 0;
+    while (bits) {
+        int k = __builtin_ctz(bits);
+        bits &= bits - 1;
+        out_xyz[3 * written] = xs[k];
+        out_xyz[3 * written + 1] = ys[k];
+        out_xyz[3 * written + 2] = zs[k];
+        out_idx[written] = v * width + u + k;
+        written++;
+    }
+    return written;
+}
+
+/*
+ * Unproject the pixels with 0 < depth < max_depth of a row-major uint16
+ * depth image: z = depth * inv_scale, x = u_norm[u] * z, y = v_norm[v] * z.
+ * Points are written in row-major pixel order to out_xyz (N x 3) with their
+ * flat pixel indices in out_idx (N), where N is unproject_count_u16().
+ * Returns N.
+ */
+__attribute__((target("avx2")))
+int64_t unproject_u16(const uint16_t *depths, int64_t height, int64_t width, uint32_t max_depth,
+                      float inv_scale, const float *u_norm, const float *v_norm,
+                      float *out_xyz, int64_t *out_idx)
+{
+    const __m256i max_v = _mm256_set1_epi32((int32_t)max_depth);
+    const __m256 inv_scale_v = _mm256_set1_ps(inv_scale);
+    int64_t n = 0;
+
+    for (int64_t v = 0; v < height; v++) {
+        const uint16_t *row = depths + v * width;
+        const __m256 v_ray = _mm256_set1_ps(v_norm[v]);
+        int64_t u = 0;
+
+        /* 16 pixels per iteration: one 256-bit load, widened to two 8 x int32 halves */
+        for (; u + 16 <= width; u += 16) {
+            __m256i d16 = _mm256_loadu_si256((const __m256i *)(row + u));
+            __m256i lo = _mm256_cvtepu16_epi32(_mm256_castsi256_si128(d16));
+            __m256i hi = _mm256_cvtepu16_epi32(_mm256_extracti128_si256(d16, 1));
+            n += unproject_lanes(lo, max_v, inv_scale_v, v_ray, u_norm, v, u, width,
+                                 out_xyz + 3 * n, out_idx + n);
+            n += unproject_lanes(hi, max_v, inv_scale_v, v_ray, u_norm, v, u + 8, width,
+                                 out_xyz + 3 * n, out_idx + n);
+        }
+        for (; u < width; u++) {
+            uint16_t d = row[u];
+            if (d > 0 && d < max_depth) {
+                float z = d * inv_scale;
+                out_xyz[3 * n] = u_norm[u] * z;
+                out_xyz[3 * n + 1] = v_norm[v] * z;
+                out_xyz[3 * n + 2] = z;
+                out_idx[n] = v * width + u;
+                n++;
+            }
+        }
+    }
+    return n;
+}
+
+#else
+
+int64_t unproject_count_u16(const uint16_t *depths, int64_t height, int64_t width, uint32_t max_depth)
+{
+    return -1;
+}
+
+int64_t unproject_u16(const uint16_t *depths, int64_t height, int64_t width, uint32_t max_depth,
+                      float inv_scale, const float *u_norm, const float *v_norm,
+                      float *out_xyz, int64_t *out_idx)
+{
+    return -1;
+}
+
+#endif